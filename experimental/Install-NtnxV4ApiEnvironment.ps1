@@ -61,7 +61,6 @@ $RepoUrl = "https://github.com/hardevsanghera/ntnx-v4api-cats.git"
 # Expected Python packages based on repository analysis
 $PythonRequirements = @"
 requests>=2.31.0
-pandas>=2.0.0
 openpyxl>=3.1.0
 urllib3>=2.0.0
 "@
@@ -1181,7 +1180,7 @@ else {
         
         # Verify installations
         Write-Info "Verifying Python package installations..."
-        $packages = @("requests", "pandas", "openpyxl", "urllib3")
+        $packages = @("requests", "openpyxl", "urllib3")
         foreach ($package in $packages) {
             try {
                 python -c "import $package; print('$package : ' + $package.__version__)"
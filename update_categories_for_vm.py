@@ -29,17 +29,50 @@ NOTES:
 import os
 import sys
 import json
+import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
 import uuid
 import requests
-import pandas as pd
 from datetime import datetime
-from base64 import b64encode
-from openpyxl import load_workbook
-from openpyxl.styles import Font, PatternFill
+from requests.adapters import HTTPAdapter
+from requests.auth import HTTPBasicAuth
+from urllib3.util.retry import Retry
 import urllib3
 
-# Disable SSL warnings for self-signed certificates
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+# Upper bound for --workers, also the connection pool size so each worker keeps its connection
+MAX_WORKERS = 8
+
+# Single HTTP session; GETs/POSTs reuse kept-alive TLS connections from its pool (one per worker)
+SESSION = requests.Session()
+SESSION.mount('https://', HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=MAX_WORKERS,
+    max_retries=Retry(total=3, backoff_factor=0.2, status_forcelist=(502, 503, 504))
+))
+SESSION.verify = False  # Skip certificate verification
+
+# Verbose request/response dumps, enabled with --debug or NTNX_DEBUG=1
+DEBUG = os.environ.get('NTNX_DEBUG', '') not in ('', '0')
+
+def parse_args():
+    """Parse command line arguments"""
+    parser = argparse.ArgumentParser(description="Update VM categories using Nutanix API v4 REST calls")
+    parser.add_argument('--debug', action='store_true',
+                        help="Pretty-print request payloads and full API responses")
+    parser.add_argument('--workers', type=int, default=1,
+                        help=f"Number of VMs to update concurrently (1-{MAX_WORKERS}, default 1)")
+    args = parser.parse_args()
+    if not 1 <= args.workers <= MAX_WORKERS:
+        parser.error(f"--workers must be between 1 and {MAX_WORKERS}")
+    return args
+
+@dataclass(frozen=True)
+class Config:
+    """Connection settings read once from vars.txt"""
+    base_url: str
+    username: str
+    password: str
 
 def read_vars_file():
     """Read configuration variables from vars.txt file"""
@@ -49,60 +82,76 @@ def read_vars_file():
         print(f"Error: vars.txt file not found at {vars_file}")
         sys.exit(1)
     
-    vars_dict = {}
     with open(vars_file, 'r') as f:
-        for line in f:
-            line = line.strip()
-            if '=' in line:
-                key, value = line.split('=', 1)
-                vars_dict[key] = value
+        data = f.read()
+    
+    vars_dict = {}
+    for line in data.splitlines():
+        line = line.strip()
+        if not line or line[0] == '#':
+            continue
+        key, sep, value = line.partition('=')
+        if sep:
+            vars_dict[key.strip()] = value.strip()
     
     return vars_dict
 
-def create_auth_header(username, password):
-    """Create Basic Authentication header"""
-    credentials = f"{username}:{password}"
-    encoded_credentials = b64encode(credentials.encode('ascii')).decode('ascii')
-    return {'Authorization': f'Basic {encoded_credentials}'}
+def load_config():
+    """Read vars.txt once and validate the required settings"""
+    vars_dict = read_vars_file()
+    config = Config(
+        base_url=vars_dict.get('baseUrl', ''),
+        username=vars_dict.get('username', ''),
+        password=vars_dict.get('password', '')
+    )
+    
+    if not all([config.base_url, config.username, config.password]):
+        print("Error: Missing required variables in vars.txt (baseUrl, username, password)")
+        sys.exit(1)
+    
+    return config
+
+def cell_text(row, i):
+    """Return the cell at position i as stripped text, '' for empty or missing cells"""
+    value = row[i] if i is not None and i < len(row) else None
+    return '' if value is None else str(value).strip()
 
-def make_get_request(base_url, uri_get, headers):
-    """Make GET request to retrieve VM information and ETag"""
+def make_get_request(base_url, uri_get):
+    """Make GET request to retrieve the VM's ETag"""
     full_url = f"{base_url}/{uri_get}"
     
     try:
         print(f"Making GET request to: {full_url}")
-        response = requests.get(
-            full_url,
-            headers=headers,
-            verify=False,  # Skip certificate verification
-            timeout=30
-        )
+        response = SESSION.request('GET', full_url, timeout=30)
+        print(f"Status Code: {response.status_code}")
         
         # Pretty print the returned JSON
-        print("GET Response JSON:")
-        print(json.dumps(response.json(), indent=2))
+        if DEBUG:
+            if response.status_code != 204 and response.content:
+                try:
+                    print("GET Response JSON:")
+                    print(json.dumps(response.json(), indent=2))
+                except json.JSONDecodeError:
+                    print("Response Text:")
+                    print(response.text)
+        elif not response.ok and response.text:
+            print("Response Text:")
+            print(response.text[:512])
         
         # Extract ETag from response headers
         vm_etag = response.headers.get('ETag', '')
         print(f"VM ETag: {vm_etag}")
         
-        return vm_etag, response.json()
+        return vm_etag
         
     except requests.exceptions.RequestException as e:
         print(f"Error making GET request: {e}")
-        return None, None
+        return None
 
 def build_categories_payload(category_uuids):
     """Build JSON payload for categories association"""
-    categories = []
-    
-    for uuid_str in category_uuids:
-        uuid_str = uuid_str.strip()
-        if uuid_str:  # Only add non-empty UUIDs
-            categories.append({"extId": uuid_str})
-    
-    payload = {"categories": categories}
-    return payload
+    # Only add non-empty UUIDs
+    return {"categories": [{"extId": u} for u in (s.strip() for s in category_uuids) if u]}
 
 def make_post_request(base_url, uri_post, headers, payload):
     """Make POST request to associate categories with VM"""
@@ -110,29 +159,28 @@ def make_post_request(base_url, uri_post, headers, payload):
     
     try:
         print(f"Making POST request to: {full_url}")
-        print("POST Payload:")
-        print(json.dumps(payload, indent=2))
+        if DEBUG:
+            print("POST Payload:")
+            print(json.dumps(payload, indent=2))
         
-        response = requests.post(
-            full_url,
-            headers=headers,
-            json=payload,
-            verify=False,  # Skip certificate verification
-            timeout=30
-        )
+        response = SESSION.request('POST', full_url, headers=headers, json=payload, timeout=30)
         
-        # Pretty print the returned response
         print("POST Response:")
         print(f"Status Code: {response.status_code}")
-        print(f"Headers: {dict(response.headers)}")
         
-        if response.text:
-            try:
-                print("Response JSON:")
-                print(json.dumps(response.json(), indent=2))
-            except json.JSONDecodeError:
-                print("Response Text:")
-                print(response.text)
+        # Pretty print the returned response
+        if DEBUG:
+            print(f"Headers: {dict(response.headers)}")
+            if response.text:
+                try:
+                    print("Response JSON:")
+                    print(json.dumps(response.json(), indent=2))
+                except json.JSONDecodeError:
+                    print("Response Text:")
+                    print(response.text)
+        elif response.status_code != 202 and response.text:
+            print("Response Text:")
+            print(response.text[:512])
         
         return response
         
@@ -140,60 +188,110 @@ def make_post_request(base_url, uri_post, headers, payload):
         print(f"Error making POST request: {e}")
         return None
 
-def update_excel_status(file_path, sheet_name, row_index, status, timestamp):
-    """Update the Excel file with status and timestamp"""
-    try:
-        workbook = load_workbook(file_path)
-        worksheet = workbook[sheet_name]
-        
-        # Find the column indices for STATUS and TIMESTAMP
-        status_col = None
-        timestamp_col = None
-        
-        for col in range(1, worksheet.max_column + 1):
-            header = worksheet.cell(row=1, column=col).value
-            if header and "STATUS OF UPDATE" in str(header).upper():
-                status_col = col
-            elif header and "TIMESTAMP" in str(header).upper():
-                timestamp_col = col
-        
-        if status_col:
-            # Update status with green background and white bold text
-            cell = worksheet.cell(row=row_index + 2, column=status_col)  # +2 because Excel is 1-indexed and we skip header
-            cell.value = status
-            cell.font = Font(color="FFFFFF", bold=True)
-            cell.fill = PatternFill(start_color="00FF00", end_color="00FF00", fill_type="solid")
-        
-        if timestamp_col:
-            # Update timestamp
-            cell = worksheet.cell(row=row_index + 2, column=timestamp_col)
-            cell.value = timestamp
-        
-        workbook.save(file_path)
-        print(f"Updated Excel file with status: {status} and timestamp: {timestamp}")
-        
-    except Exception as e:
-        print(f"Error updating Excel file: {e}")
+@dataclass
+class StatusSheet:
+    """Writable ToUpdate sheet with its status columns and cell styles resolved once"""
+    worksheet: object
+    status_col: object
+    timestamp_col: object
+    status_font: object
+    status_fill: object
+
+def open_status_sheet(workbook, sheet_name, status_font, status_fill):
+    """Find the STATUS OF UPDATE and TIMESTAMP columns of the sheet once"""
+    worksheet = workbook[sheet_name]
+    
+    # Find the column indices for STATUS and TIMESTAMP
+    status_col = None
+    timestamp_col = None
+    
+    for col in range(1, worksheet.max_column + 1):
+        header = worksheet.cell(row=1, column=col).value
+        if header and "STATUS OF UPDATE" in str(header).upper():
+            status_col = col
+        elif header and "TIMESTAMP" in str(header).upper():
+            timestamp_col = col
+    
+    return StatusSheet(worksheet, status_col, timestamp_col, status_font, status_fill)
+
+def record_status(sheet, row_index, vm_name, status, timestamp):
+    """Write status and timestamp for a row; the workbook is saved once at the end"""
+    if sheet.status_col:
+        # Update status with green background and white bold text
+        cell = sheet.worksheet.cell(row=row_index + 2, column=sheet.status_col)  # +2 because Excel is 1-indexed and we skip header
+        cell.value = status
+        cell.font = sheet.status_font
+        cell.fill = sheet.status_fill
+    
+    if sheet.timestamp_col:
+        # Update timestamp
+        cell = sheet.worksheet.cell(row=row_index + 2, column=sheet.timestamp_col)
+        cell.value = timestamp
+    
+    print(f"Recorded status for VM {vm_name} (row {row_index + 1}): {status} at {timestamp}")
+
+def process_vm(base_url, timestamp, index, vm_name, vm_extid, category_uuids):
+    """GET the VM's ETag and POST its categories; return (row_index, vm_name, status, timestamp) or None"""
+    print(f"\n{'='*60}")
+    print(f"Processing VM: {vm_name} (extId: {vm_extid})")
+    print(f"Category UUIDs: {', '.join(category_uuids)}")
+    
+    # Initialize URI variables
+    uri_get = f"vmm/v4.1/ahv/config/vms/{vm_extid}"
+    uri_post = f"vmm/v4.1/ahv/config/vms/{vm_extid}/$actions/associate-categories"
+    
+    # 1st REST call: GET
+    print(f"\n1. Making GET request for {vm_name}...")
+    vm_etag = make_get_request(base_url, uri_get)
+    
+    if not vm_etag:
+        print(f"Failed to get ETag for VM {vm_name}, skipping...")
+        return None
+    
+    # Build JSON payload for POST
+    payload = build_categories_payload(category_uuids)
+    
+    # Generate REST UUID (idempotency key), only once the POST will be sent
+    rest_uuid = str(uuid.uuid4())
+    
+    # Prepare per-request POST headers (auth comes from the session,
+    # Content-Type from the json= payload)
+    post_headers = {
+        'If-Match': vm_etag,
+        'NTNX-Request-Id': rest_uuid
+    }
+    
+    # 2nd REST call: POST
+    print(f"\n2. Making POST request for {vm_name}...")
+    post_response = make_post_request(base_url, uri_post, post_headers, payload)
+    
+    if post_response is not None and post_response.status_code == 202:
+        # Success - extract ETag from response headers
+        vm_etag_updated = post_response.headers.get('ETag', '')
+        print(f"ACCEPTED: {vm_name} updated VM ETag: {vm_etag_updated}")
+        return index, vm_name, 'ACCEPTED', timestamp
+    
+    status_code = post_response.status_code if post_response is not None else 'N/A'
+    print(f"FAILED: POST request for {vm_name} failed with status code: {status_code}")
+    return index, vm_name, f'FAILED ({status_code})', timestamp
 
 def main():
     """Main function to process VMs and update categories"""
+    global DEBUG
+    args = parse_args()
+    DEBUG = DEBUG or args.debug
+    
     print("Starting update_categories_for_vm.py script")
     
     # Read configuration variables
-    vars_dict = read_vars_file()
-    base_url = vars_dict.get('baseUrl', '')
-    username = vars_dict.get('username', '')
-    password = vars_dict.get('password', '')
-    
-    if not all([base_url, username, password]):
-        print("Error: Missing required variables in vars.txt (baseUrl, username, password)")
-        sys.exit(1)
+    config = load_config()
+    base_url = config.base_url
     
     print(f"Using base URL: {base_url}")
-    print(f"Using username: {username}")
+    print(f"Using username: {config.username}")
     
-    # Create authentication headers
-    auth_headers = create_auth_header(username, password)
+    # Attach Basic authentication to the shared session
+    SESSION.auth = HTTPBasicAuth(config.username, config.password)
     
     # Read Excel file
     excel_file = os.path.join(os.getcwd(), 'scratch', 'VMsToUpdate-PROD.xlsx')
@@ -202,90 +300,109 @@ def main():
         print(f"Error: Excel file not found at {excel_file}")
         sys.exit(1)
     
+    # Deferred so --help and the error exits above don't pay for importing openpyxl
+    from openpyxl import load_workbook
+    from openpyxl.styles import Font, PatternFill
+    
+    # Disable SSL warnings for self-signed certificates
+    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+    
     try:
-        # Read the Excel file
-        df = pd.read_excel(excel_file, sheet_name='ToUpdate')
-        print(f"Loaded Excel file with {len(df)} rows")
+        # Stream the sheet's cached values; resolve column positions from the header once
+        read_workbook = load_workbook(excel_file, read_only=True, data_only=True)
+        rows = read_workbook['ToUpdate'].iter_rows(values_only=True)
+        header = next(rows, ())
+        columns = {name: i for i, name in enumerate(header) if name is not None}
+        match_col = columns.get('VM Name/extId & Category exId(s) Match')
+        name_col = columns.get('VM Name')
+        extid_col = columns.get('VM extId')
+        category_col = columns.get('Category UUID(s)')
         
     except Exception as e:
         print(f"Error reading Excel file: {e}")
         sys.exit(1)
     
-    # Process each row
-    for index, row in df.iterrows():
+    # Collect the rows to update
+    jobs = []
+    row_count = 0
+    for index, row in enumerate(rows):
+        if all(value is None for value in row):
+            continue  # Blank row
+        row_count += 1
+        
         # Check if the match status is "OK"
-        match_status = str(row.get('VM Name/extId & Category exId(s) Match', '')).strip()
+        match_status = cell_text(row, match_col)
         
         if match_status.upper() == 'OK':
-            vm_name = str(row.get('VM Name', '')).strip()
-            vm_extid = str(row.get('VM extId', '')).strip()
-            category_uuids_str = str(row.get('Category UUID(s)', '')).strip()
+            vm_name = cell_text(row, name_col)
+            vm_extid = cell_text(row, extid_col)
+            category_uuids_str = cell_text(row, category_col)
             
             if not all([vm_name, vm_extid, category_uuids_str]):
                 print(f"Skipping row {index + 1}: Missing required data")
                 continue
             
-            print(f"\n{'='*60}")
-            print(f"Processing VM: {vm_name} (extId: {vm_extid})")
-            print(f"Category UUIDs: {category_uuids_str}")
-            
             # Parse category UUIDs (comma-separated)
-            category_uuids = [uuid.strip() for uuid in category_uuids_str.split(',') if uuid.strip()]
+            category_uuids = [u for u in (part.strip() for part in category_uuids_str.split(',')) if u]
             
             if not category_uuids:
                 print(f"No valid category UUIDs found for VM {vm_name}")
                 continue
             
-            # Initialize URI variables
-            uri_get = f"vmm/v4.1/ahv/config/vms/{vm_extid}"
-            uri_post = f"vmm/v4.1/ahv/config/vms/{vm_extid}/$actions/associate-categories"
-            
-            # Generate REST UUID
-            rest_uuid = str(uuid.uuid4())
-            
-            # 1st REST call: GET
-            print(f"\n1. Making GET request...")
-            vm_etag, get_response = make_get_request(base_url, uri_get, auth_headers)
-            
-            if not vm_etag:
-                print(f"Failed to get ETag for VM {vm_name}, skipping...")
-                continue
-            
-            # Build JSON payload for POST
-            payload = build_categories_payload(category_uuids)
-            
-            # Prepare POST headers
-            post_headers = auth_headers.copy()
-            post_headers.update({
-                'If-Match': vm_etag,
-                'NTNX-Request-Id': rest_uuid,
-                'Content-Type': 'application/json'
-            })
-            
-            # 2nd REST call: POST
-            print(f"\n2. Making POST request...")
-            post_response = make_post_request(base_url, uri_post, post_headers, payload)
-            
-            if post_response and post_response.status_code == 202:
-                # Success - extract ETag from response headers
-                vm_etag_updated = post_response.headers.get('ETag', '')
-                print(f"ACCEPTED: Updated VM ETag: {vm_etag_updated}")
-                
-                # Update Excel with success status
-                timestamp = datetime.now().strftime("%d%m%Y-%H%M")
-                update_excel_status(excel_file, 'ToUpdate', index, 'ACCEPTED', timestamp)
-                
-            else:
-                status_code = post_response.status_code if post_response else 'N/A'
-                print(f"FAILED: POST request failed with status code: {status_code}")
-                
-                # Update Excel with failure status
-                timestamp = datetime.now().strftime("%d%m%Y-%H%M")
-                update_excel_status(excel_file, 'ToUpdate', index, f'FAILED ({status_code})', timestamp)
+            jobs.append((index, vm_name, vm_extid, category_uuids))
         
         else:
             print(f"Skipping row {index + 1}: Match status is '{match_status}', not 'OK'")
     
+    read_workbook.close()
+    print(f"Read {row_count} rows from Excel file")
+    
+    # Open the workbook for status updates once, before any VM is changed
+    try:
+        workbook = load_workbook(excel_file)
+        sheet = open_status_sheet(
+            workbook, 'ToUpdate',
+            Font(color="FFFFFF", bold=True),
+            PatternFill(start_color="00FF00", end_color="00FF00", fill_type="solid")
+        )
+    except Exception as e:
+        print(f"Error opening Excel file for status updates: {e}")
+        sys.exit(1)
+    
+    # One status timestamp (DDMMYYYY-HHMM) for the whole run
+    timestamp = datetime.now().strftime("%d%m%Y-%H%M")
+    
+    # Process the VMs, --workers at a time, and record each outcome in Excel
+    print(f"\nUpdating {len(jobs)} VM(s) with {args.workers} worker(s)")
+    recorded = 0
+    futures = set()
+    executor = ThreadPoolExecutor(max_workers=args.workers)
+    try:
+        futures.update(executor.submit(process_vm, base_url, timestamp, *job) for job in jobs)
+        for future in as_completed(futures):
+            futures.discard(future)
+            result = future.result()
+            if result:
+                record_status(sheet, *result)
+                recorded += 1
+        executor.shutdown()
+    except BaseException:
+        # Interrupted: drop queued VMs, let in-flight ones finish and record them too
+        executor.shutdown(cancel_futures=True)
+        for future in futures:
+            if not future.cancelled() and future.exception() is None and future.result():
+                record_status(sheet, *future.result())
+                recorded += 1
+        raise
+    finally:
+        # Save every recorded status in a single write
+        if recorded:
+            try:
+                workbook.save(excel_file)
+                print(f"\nUpdated Excel file with {recorded} status update(s)")
+            except Exception as e:
+                print(f"Error updating Excel file: {e}")
+    
     print(f"\n{'='*60}")
     print("Script completed!")
 